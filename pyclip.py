@@ -1,10 +1,13 @@
+import bisect
 import os
+import stat
 import sys
 import subprocess
 import re
 import logging
 
-from argparse import ArgumentParser
+from collections.abc import Iterable
+from typing import NamedTuple
 
 
 logger = logging.getLogger(__name__)
@@ -13,17 +16,53 @@ logger = logging.getLogger(__name__)
 # Used to validate timestamps for ffmpeg
 TIMESTAMP_PATTERN = re.compile(r"""(?x)
                                ^-? # Optional minus sign
-                               (?:(?:[0-9]+:)?[0-9]{2}:[0-9]{2}(?:\.[0-9]+)?) # [HH:]MM:SS[.m...]
-                               | (?:^-?[0-9]+(?:(?:\.[0-9]+)|(?:[mu]?s))?) # S+[.m...][s|ms|us]
+                               (?:(?:[0-9]+:)?[0-9]{1,2}:[0-9]{1,2}(?:\.[0-9]+)? # [HH:]MM:SS[.m...]
+                               | [0-9]+(?:\.[0-9]+)?(?:s|ms|us)?) # S+[.m...][s|ms|us]
                                $
                                """)
 
-# Usee to extract filenames and file extensions
-FILENAME_PATTERN = re.compile(r"""(?x)
-                              (?P<name>^.*) # name
-                              \. # dot
-                              (?P<extension>.*$) # extension
-                              """)
+# Maximum distance in seconds between a clip start and the preceding keyframe
+# for the clip to be stream copied when the copy mode is detected automatically
+KEYFRAME_TOLERANCE = 0.05
+
+# Probe results memoized by _keyframes, keyed by (real path, size, mtime)
+_keyframes_cache : dict[tuple[str, int, int], dict] = {}
+
+
+def _seconds(timestamp : str) -> float:
+    """
+    Convert an FFMPEG timestamp to a number of seconds.
+
+    Args:
+        timestamp (str): Timestamp in FFMPEG format, either [-][HH:]MM:SS[.m...]
+                         or [-]S+[.m...][s|ms|us]
+
+    Raises:
+        ValueError: If the timestamp could not be parsed
+
+    Returns:
+        float: The timestamp in seconds
+    """
+    sign = 1
+    if timestamp.startswith("-"):
+        sign = -1
+        timestamp = timestamp[1:]
+    if ":" in timestamp:
+        parts = timestamp.split(":")
+        if len(parts) > 3:
+            raise ValueError(f"{timestamp} is not a valid timestamp")
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+    elif timestamp.endswith("ms"):
+        seconds = float(timestamp[:-2]) / 1_000
+    elif timestamp.endswith("us"):
+        seconds = float(timestamp[:-2]) / 1_000_000
+    elif timestamp.endswith("s"):
+        seconds = float(timestamp[:-1])
+    else:
+        seconds = float(timestamp)
+    return sign * seconds
 
 
 class Formatter(logging.Formatter):
@@ -44,8 +83,31 @@ class Formatter(logging.Formatter):
         logging.CRITICAL: RED_BOLD
     }
 
+    def __init__(self,
+                 fmt : str | None = None,
+                 datefmt : str | None = None,
+                 style : str = "%",
+                 use_color : bool = True):
+        """
+        Args:
+            fmt (str | None, optional): Format string, as for logging.Formatter. Defaults to None.
+            datefmt (str | None, optional): Date format string, as for logging.Formatter. Defaults to None.
+            style (str, optional): Format string style, as for logging.Formatter. Defaults to "%".
+            use_color (bool, optional): Wrap records in ANSI color codes. Defaults to True.
+        """
+        super().__init__(fmt, datefmt, style)
+        self.use_color = use_color
+        # One formatter per level with the color codes baked in its format string
+        self._formatters = {}
+        if use_color:
+            self._formatters = {level: logging.Formatter("".join((color, self._fmt, self.RESET)), datefmt, style)
+                                for level, color in self.FORMATS.items()}
+
     def format(self, record):
-        return self.FORMATS[record.levelno] + super().format(record) + self.RESET
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
+        return formatter.format(record)
 
 
 def _init_logger(level : int):
@@ -68,12 +130,28 @@ def _init_logger(level : int):
         logger.setLevel(logging.DEBUG)
     else:
         raise ValueError(f"{level} is not a valid verbosity level")
+    if level == 0:
+        # Warnings and errors are printed on stderr by the logging module's last resort handler
+        return
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logger.level)
-    handler.setFormatter(Formatter("%(message)s"))
+    handler.setFormatter(Formatter("%(message)s", use_color = sys.stdout.isatty()))
     logger.addHandler(handler)
 
 
+class Clip(NamedTuple):
+    """A single clip to extract"""
+
+    start : str
+    """Clip start time in FFMPEG timestamp format"""
+    end : str
+    """Clip end time in FFMPEG timestamp format"""
+    outfile : os.PathLike | str
+    """The output video file"""
+    copy : bool = False
+    """Perform a simple copy and do not transcode"""
+
+
 def clip(infile : os.PathLike | str,
          outfile : os.PathLike | str,
          start_timestamp : str,
@@ -81,7 +159,8 @@ def clip(infile : os.PathLike | str,
          no_audio : bool = False,
          no_video : bool = False,
          overwrite : bool = False,
-         copy : bool = False):
+         copy : bool = False,
+         threads : int | None = None):
     """
     Invokes FFMPEG to extract a video clip between the specified timestamps.
 
@@ -94,28 +173,586 @@ def clip(infile : os.PathLike | str,
         no_video (bool, optional): Do not copy the video streams to the output. Defaults to False.
         overwrite (bool, optional): Overwrite already existing files. Defaults to False.
         copy (bool, optional): Perform a simple copy and do not transcode. Defaults to False.
+        threads (int | None, optional): Number of threads used by FFMPEG for decoding and encoding.
+                                        Defaults to None (let FFMPEG decide).
+
+    Raises:
+        RuntimeError: If FFMPEG failed
     """
-    command = ["ffmpeg",
-               "-loglevel", "fatal",
-               "-i", infile,
-               "-ss", start_timestamp,
-               "-to", end_timestamp]
-    if copy:
-        command.extend(["-c", "copy"])
+    clip_many(infile, [Clip(start_timestamp, end_timestamp, outfile, copy)],
+              no_audio, no_video, overwrite, threads)
+
+
+def clip_many(infile : os.PathLike | str,
+              clips : Iterable[Clip],
+              no_audio : bool = False,
+              no_video : bool = False,
+              overwrite : bool = False,
+              threads : int | None = None):
+    """
+    Invokes FFMPEG once to extract several video clips from the same input.
+
+    Every clip is written as a separate output of the same FFMPEG process.
+    Transcoded clips share a single opening of the input, stream copied clips
+    open it once each so that they can use a keyframe seek.
+
+    Args:
+        infile (os.PathLike): The source video stream
+        clips (Iterable[Clip]): The clips to extract
+        no_audio (bool, optional): Do not copy the audio streams to the outputs. Defaults to False.
+        no_video (bool, optional): Do not copy the video streams to the outputs. Defaults to False.
+        overwrite (bool, optional): Overwrite already existing files. Defaults to False.
+        threads (int | None, optional): Number of threads used by FFMPEG for decoding and encoding.
+                                        Defaults to None (let FFMPEG decide).
+
+    Raises:
+        RuntimeError: If FFMPEG failed
+    """
+    _run_ffmpeg(_clip_command(infile, clips, no_audio, no_video, overwrite, threads))
+
+
+def clip_segments(infile : os.PathLike | str,
+                  clips : Iterable[Clip],
+                  no_audio : bool = False,
+                  no_video : bool = False,
+                  overwrite : bool = False,
+                  threads : int | None = None):
+    """
+    Invokes FFMPEG once to split a contiguous range of the input into stream copied clips.
+
+    The segment muxer reads the range in a single pass, which avoids seeking
+    for every clip. Each clip must start where the previous one ends, on a
+    keyframe (see _segmentable), the copy flag of the clips is ignored as
+    streams are always copied. If FFMPEG does not produce one segment per clip,
+    they are extracted again by clip_many.
+
+    Args:
+        infile (os.PathLike): The source video stream
+        clips (Iterable[Clip]): The clips to extract, in order
+        no_audio (bool, optional): Do not copy the audio streams to the outputs. Defaults to False.
+        no_video (bool, optional): Do not copy the video streams to the outputs. Defaults to False.
+        overwrite (bool, optional): Overwrite already existing files. Defaults to False.
+        threads (int | None, optional): Number of threads used by FFMPEG for decoding.
+                                        Defaults to None (let FFMPEG decide).
+
+    Raises:
+        RuntimeError: If FFMPEG failed or an output file already exists and overwrite is False
+    """
+    import shutil
+    import tempfile
+
+    clips = list(clips)
+    if not overwrite:
+        for item in clips:
+            if os.path.exists(item.outfile):
+                raise RuntimeError(f"File '{item.outfile}' already exists")
+    start = _seconds(clips[0].start)
+    ends = [_seconds(item.end) - start for item in clips]
+
+    # Segments are written with generated names next to the outputs, then renamed
+    segment_dir = tempfile.mkdtemp(prefix = ".pyclip-",
+                                   dir = os.path.dirname(os.fspath(clips[0].outfile)) or os.curdir)
+    try:
+        extension = os.path.splitext(clips[0].outfile)[1]
+        pattern = os.path.join(segment_dir.replace("%", "%%"), "%03d" + extension.replace("%", "%%"))
+        command = ["ffmpeg",
+                   "-nostdin",
+                   "-loglevel", "error",
+                   "-y"]
+        if threads is not None:
+            command.extend(["-threads", str(threads)])
+        command.extend(["-ss", clips[0].start,
+                        "-i", os.fspath(infile),
+                        "-t", f"{ends[-1]:.6f}",
+                        "-c", "copy"])
+        if no_audio:
+            command.append("-an")
+        if no_video:
+            command.append("-vn")
+        command.extend(["-f", "segment",
+                        "-segment_times", ",".join(f"{end:.6f}" for end in ends[:-1]),
+                        "-reset_timestamps", "1",
+                        pattern])
+        _run_ffmpeg(command)
+
+        segments = sorted(os.listdir(segment_dir), key = lambda segment: int(os.path.splitext(segment)[0]))
+        if len(segments) == len(clips):
+            for segment, item in zip(segments, clips):
+                os.replace(os.path.join(segment_dir, segment), item.outfile)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors = True)
+    if len(segments) != len(clips):
+        logger.warning("FFMPEG produced %s segments instead of %s, extracting the clips separately",
+                       len(segments), len(clips))
+        clip_many(infile, clips, no_audio, no_video, overwrite, threads)
+
+
+def _segmentable(clips : list[Clip], keyframe_aligned : bool) -> bool:
+    """
+    Check whether clips can be extracted by clip_segments.
+
+    Args:
+        clips (list[Clip]): The clips to extract
+        keyframe_aligned (bool): Whether the start of the stream copied clips
+                                 was checked to fall on a keyframe
+
+    Returns:
+        bool: True if there are several clips, all stream copied from a keyframe,
+              each starting where the previous one ends
+    """
+    if not keyframe_aligned or len(clips) < 2 or not all(item.copy for item in clips):
+        return False
+    try:
+        for previous, item in zip(clips, clips[1:]):
+            if abs(_seconds(item.start) - _seconds(previous.end)) > 1e-6:
+                return False
+        return all(_seconds(item.end) > _seconds(item.start) for item in clips)
+    except ValueError:
+        return False
+
+
+def _run_ffmpeg(command : list[str]):
+    """
+    Run an FFMPEG command without terminal interaction.
+
+    Args:
+        command (list[str]): The FFMPEG command line
+
+    Raises:
+        RuntimeError: If FFMPEG could not be run or failed, with its error output as message
+    """
+    try:
+        subprocess.run(command,
+                       check = True,
+                       stdin = subprocess.DEVNULL,
+                       stdout = subprocess.DEVNULL,
+                       stderr = subprocess.PIPE,
+                       text = True,
+                       errors = "replace")
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError(f"FFMPEG exited with code {error.returncode} : {error.stderr.strip()}") from error
+    except OSError as error:
+        raise RuntimeError(f"FFMPEG could not be run : {error}") from error
+
+
+def _clip_command(infile : os.PathLike | str,
+                  clips : Iterable[Clip],
+                  no_audio : bool = False,
+                  no_video : bool = False,
+                  overwrite : bool = False,
+                  threads : int | None = None) -> list[str]:
+    """
+    Build the FFMPEG command run by clip_many.
+
+    Args:
+        infile (os.PathLike): The source video stream
+        clips (Iterable[Clip]): The clips to extract
+        no_audio (bool, optional): Do not copy the audio streams to the outputs. Defaults to False.
+        no_video (bool, optional): Do not copy the video streams to the outputs. Defaults to False.
+        overwrite (bool, optional): Overwrite already existing files. Defaults to False.
+        threads (int | None, optional): Number of threads used by FFMPEG for decoding and encoding.
+                                        Defaults to None (let FFMPEG decide).
+
+    Returns:
+        list[str]: The FFMPEG command line
+    """
+    input_flags = []
+    flags = []
+    if threads is not None:
+        input_flags.extend(["-threads", str(threads)])
+        flags.extend(["-threads", str(threads)])
     if no_audio:
-        command.append("-an")
+        flags.append("-an")
     if no_video:
-        command.append("-vn")
-    if overwrite:
-        command.append("-y")
+        flags.append("-vn")
+
+    # Stream copied clips get a keyframe seek on their own input, which requires a -t duration
+    clips = list(clips)
+    durations = []
+    for item in clips:
+        duration = None
+        if item.copy:
+            try:
+                duration = _seconds(item.end) - _seconds(item.start)
+            except ValueError:
+                pass
+        durations.append(duration)
+    shared = any(duration is None for duration in durations)
+    input_total = shared + sum(duration is not None for duration in durations)
+
+    command = ["ffmpeg",
+               "-nostdin",
+               "-loglevel", "error",
+               "-y" if overwrite else "-n"]
+    if shared:
+        command.extend(input_flags)
+        command.extend(["-i", infile])
+    input_nb = int(shared)
+    for item, duration in zip(clips, durations):
+        if duration is None:
+            # Seek on the output: the shared input is decoded up to the start timestamp
+            input_index = 0
+            command.extend(["-ss", item.start,
+                            "-to", item.end])
+        else:
+            input_index = input_nb
+            input_nb += 1
+            command.extend(input_flags)
+            command.extend(["-ss", item.start,
+                            "-i", infile,
+                            "-t", f"{duration:.6f}"])
+        if input_total > 1:
+            # FFMPEG's default selection would pick streams from any input: restrict each output
+            # to the first video stream (excluding cover art) and first audio stream of its input
+            command.extend(["-map", f"{input_index}:V:0?",
+                            "-map", f"{input_index}:a:0?"])
+        if item.copy:
+            command.extend(["-c", "copy"])
+        command.extend(flags)
+        command.append(item.outfile)
+    return [os.fspath(argument) for argument in command]
+
+
+def _cache_dir() -> str:
+    """
+    Get the directory storing the pyclip cache.
+
+    Returns:
+        str: $XDG_CACHE_HOME/pyclip, or ~/.cache/pyclip if the variable is not set
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "pyclip")
+
+
+def _read_keyframes_cache(cache_file : str, key : tuple[str, int, int]) -> dict | None:
+    """
+    Read a probe result stored on disk by _write_keyframes_cache.
+
+    Args:
+        cache_file (str): Path to the cache file
+        key (tuple[str, int, int]): (real path, size, mtime) of the probed file
+
+    Returns:
+        dict | None: The cached probe result (see _keyframes), None if the cache is missing,
+                     unreadable or was written for another version of the file
+    """
+    import json
+
+    try:
+        with open(cache_file, encoding = "utf-8") as file:
+            data = json.load(file)
+        if (data["path"], data["size"], data["mtime_ns"]) != key:
+            return None
+        return {"start_time": float(data["start_time"]),
+                "video": bool(data["video"]),
+                "windows": [[float(window_start), float(window_end)]
+                            for window_start, window_end in data["windows"]],
+                "keyframes": [float(keyframe) for keyframe in data["keyframes"]]}
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+
+def _write_keyframes_cache(cache_file : str, key : tuple[str, int, int], probe : dict):
+    """
+    Store a probe result on disk, failures are logged and otherwise ignored.
+
+    Args:
+        cache_file (str): Path to the cache file
+        key (tuple[str, int, int]): (real path, size, mtime) of the probed file
+        probe (dict): The probe result to store (see _keyframes)
+    """
+    import json
+    import tempfile
+
+    path, size, mtime_ns = key
+    temp_name = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        with tempfile.NamedTemporaryFile("w",
+                                         encoding = "utf-8",
+                                         dir = os.path.dirname(cache_file),
+                                         delete = False) as file:
+            temp_name = file.name
+            json.dump({"path": path, "size": size, "mtime_ns": mtime_ns, **probe}, file)
+        os.replace(temp_name, cache_file)
+    except (OSError, TypeError, ValueError) as error:
+        if temp_name is not None:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+        logger.debug("Keyframes could not be cached : %s", error)
+
+
+def _run_ffprobe(arguments : list[str]) -> str:
+    """
+    Run FFPROBE without terminal interaction.
+
+    Args:
+        arguments (list[str]): The FFPROBE arguments
+
+    Raises:
+        RuntimeError: If FFPROBE could not be run or failed, with its error output as message
+
+    Returns:
+        str: The FFPROBE output
+    """
+    try:
+        result = subprocess.run(["ffprobe", "-v", "error", *arguments],
+                                check = True,
+                                stdin = subprocess.DEVNULL,
+                                capture_output = True,
+                                text = True,
+                                errors = "replace")
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError(f"FFPROBE exited with code {error.returncode} : {error.stderr.strip()}") from error
+    except OSError as error:
+        raise RuntimeError(f"FFPROBE could not be run : {error}") from error
+    return result.stdout
+
+
+def _parse_probe_info(output : str) -> tuple[bool, float]:
+    """
+    Parse the stream and format sections printed by FFPROBE in CSV format.
+
+    Args:
+        output (str): FFPROBE output for stream=index:format=start_time
+
+    Returns:
+        tuple[bool, float]: Whether a video stream was listed and the container start time,
+                            0 if it is unknown
+    """
+    has_video = False
+    start_time = 0.0
+    for line in output.splitlines():
+        section, _, value = line.partition(",")
+        if section == "stream":
+            has_video = True
+        elif section == "format" and value not in ("", "N/A"):
+            start_time = float(value)
+    return has_video, start_time
+
+
+def _parse_keyframes(output : str, start_time : float) -> list[float]:
+    """
+    Parse the packets printed by FFPROBE in CSV format.
+
+    Args:
+        output (str): FFPROBE output for packet=pts_time,flags without section names
+        start_time (float): Container start time, subtracted from the packet timestamps
+
+    Returns:
+        list[float]: Sorted keyframe timestamps in seconds, relative to the start time
+                     as for the FFMPEG -ss option. Packets without timestamp are ignored.
+    """
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, packet_flags = line.partition(",")
+        if "K" in packet_flags and pts_time != "N/A":
+            # Rounded to the microsecond precision of FFPROBE to cancel subtraction errors
+            keyframes.append(round(float(pts_time) - start_time, 6))
+    keyframes.sort()
+    return keyframes
+
+
+def _keyframes(infile : os.PathLike | str,
+               starts : Iterable[float],
+               use_cache : bool = True) -> list[float] | None:
+    """
+    List the keyframes of the first video stream of a file around clip starts.
+
+    Only the packets within KEYFRAME_TOLERANCE of each start are probed. Probe results
+    are memoized and, unless disabled, cached on disk across runs as long as the file
+    size and modification time do not change, so that only new starts are probed.
+
+    Args:
+        infile (os.PathLike): The source video stream
+        starts (Iterable[float]): Clip start times in seconds
+        use_cache (bool, optional): Read and write the on-disk cache. Defaults to True.
+
+    Raises:
+        RuntimeError: If FFPROBE failed
+
+    Returns:
+        list[float] | None: Sorted keyframe timestamps in seconds, relative to the
+                            container start time, None if the file has no video stream
+    """
+    import hashlib
+
+    path = os.path.realpath(infile)
+    stat_result = os.stat(path)
+    key = (path, stat_result.st_size, stat_result.st_mtime_ns)
+    cache_file = os.path.join(_cache_dir(),
+                              f"probe-{hashlib.sha256(path.encode()).hexdigest()}.json")
+    changed = False
+    probe = _keyframes_cache.get(key)
+    if probe is None and use_cache:
+        probe = _read_keyframes_cache(cache_file, key)
+        if probe is not None:
+            logger.debug("Keyframes read from cache : %s", cache_file)
+    if probe is None:
+        has_video, start_time = _parse_probe_info(_run_ffprobe(["-select_streams", "V:0",
+                                                                "-show_entries", "stream=index:format=start_time",
+                                                                "-of", "csv=print_section=1",
+                                                                os.fspath(infile)]))
+        probe = {"start_time": start_time, "video": has_video, "windows": [], "keyframes": []}
+        changed = True
+
+    if probe["video"]:
+        # Time windows in which a keyframe allows a clip to be stream copied
+        windows = [[max(0.0, start - KEYFRAME_TOLERANCE), start + KEYFRAME_TOLERANCE] for start in starts]
+        missing = [window for window in windows
+                   if not any(probed_start <= window[0] and window[1] <= probed_end
+                              for probed_start, probed_end in probe["windows"])]
+        if missing:
+            # Intervals are absolute stream times, unlike the -ss option
+            start_time = probe["start_time"]
+            intervals = ",".join(f"{window_start + start_time:.6f}%{window_end + start_time:.6f}"
+                                 for window_start, window_end in missing)
+            keyframes = _parse_keyframes(_run_ffprobe(["-select_streams", "V:0",
+                                                       "-read_intervals", intervals,
+                                                       "-show_entries", "packet=pts_time,flags",
+                                                       "-of", "csv=print_section=0",
+                                                       os.fspath(infile)]),
+                                         start_time)
+            probe["keyframes"] = sorted(set(probe["keyframes"]).union(keyframes))
+            probe["windows"].extend(missing)
+            changed = True
+
+    _keyframes_cache[key] = probe
+    if changed and use_cache:
+        _write_keyframes_cache(cache_file, key, probe)
+    return probe["keyframes"] if probe["video"] else None
+
+
+def _keyframe_start(keyframes : list[float], start_timestamp : str) -> str | None:
+    """
+    Find a keyframe to start a stream copied clip from.
+
+    Args:
+        keyframes (list[float]): Sorted keyframe timestamps in seconds
+        start_timestamp (str): Requested clip start time in FFMPEG timestamp format
+
+    Returns:
+        str | None: Start time of the keyframe preceding the requested timestamp
+                    if it lies within KEYFRAME_TOLERANCE of it, None otherwise
+    """
+    start = _seconds(start_timestamp)
+    index = bisect.bisect_right(keyframes, start) - 1
+    if index < 0 or start - keyframes[index] >= KEYFRAME_TOLERANCE:
+        return None
+    return f"{keyframes[index]:.6f}"
+
+
+def _threads_per_job(jobs : int) -> int:
+    """
+    Compute the number of threads to give each FFMPEG process so that
+    running jobs in parallel does not oversubscribe the CPUs.
+
+    Args:
+        jobs (int): Number of FFMPEG processes running concurrently
+
+    Returns:
+        int: Number of threads per FFMPEG process, at least 1
+    """
+    return max(1, (os.cpu_count() or 1) // jobs)
+
+
+def _ffmpeg_threads(value : str) -> int:
+    """
+    Argument type for the number of FFMPEG threads.
+
+    Args:
+        value (str): The command line value
+
+    Raises:
+        ArgumentTypeError: If the value is not an integer between 1 and 64 (inclusive)
+
+    Returns:
+        int: The number of threads
+    """
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if not 1 <= threads <= 64:
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError(f"{value} is not an integer between 1 and 64")
+    return threads
+
+
+def _timestamp(value : str) -> str:
+    """
+    Argument type for FFMPEG timestamps.
+
+    Args:
+        value (str): The command line value
+
+    Raises:
+        ArgumentTypeError: If the value is not a valid FFMPEG timestamp
+
+    Returns:
+        str: The timestamp, unchanged
+    """
+    if TIMESTAMP_PATTERN.fullmatch(value) is None:
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError(f"{value} is not a valid timestamp")
+    return value
+
+
+def _extract(infile : os.PathLike | str,
+             clips : list[Clip],
+             no_audio : bool,
+             no_video : bool,
+             overwrite : bool,
+             jobs : int,
+             threads : int | None,
+             keyframe_aligned : bool):
+    """
+    Extract clips with a single segmenting pass when possible, otherwise
+    with a single FFMPEG invocation or a pool of parallel jobs.
+
+    Args:
+        infile (os.PathLike): The source video stream
+        clips (list[Clip]): The clips to extract
+        no_audio (bool): Do not copy the audio streams to the outputs
+        no_video (bool): Do not copy the video streams to the outputs
+        overwrite (bool): Overwrite already existing files
+        jobs (int): Maximum number of clips to extract in parallel
+        threads (int | None): Number of threads used by each FFMPEG process,
+                              None to split the CPUs between parallel jobs
+        keyframe_aligned (bool): Whether the start of the stream copied clips
+                                 was checked to fall on a keyframe
+
+    Raises:
+        RuntimeError: If FFMPEG failed
+    """
+    segmented = _segmentable(clips, keyframe_aligned)
+    workers = 1 if segmented else min(jobs, len(clips))
+    if threads is None and workers > 1:
+        threads = _threads_per_job(workers)
+    logger.debug("FFMPEG threads : %s", "auto" if threads is None else threads)
+
+    if segmented:
+        logger.info("Extracting %s contiguous clips in a single pass", len(clips))
+        clip_segments(infile, clips, no_audio, no_video, overwrite, threads)
+    elif workers == 1:
+        logger.info("Extracting %s clip(s)", len(clips))
+        clip_many(infile, clips, no_audio, no_video, overwrite, threads)
     else:
-        command.append("-n")
-    command.append(outfile)
-    subprocess.run(command, check = True)
+        from concurrent.futures import ThreadPoolExecutor
+
+        logger.info("Extracting %s clips with %s jobs", len(clips), workers)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(lambda item: clip(infile, item.outfile, item.start, item.end,
+                                                no_audio, no_video, overwrite, item.copy, threads),
+                              clips))
 
 
 def main():
     """Main function"""
+    from argparse import ArgumentParser, BooleanOptionalAction
+
     clparser = ArgumentParser("pyclip")
     clparser.add_argument("-v", "--verbose",
                           action = "count",
@@ -136,58 +773,148 @@ def main():
                           action = "store_true",
                           help = "Overwrite existing output files, defaults to no")
     clparser.add_argument("--copy",
+                          action = BooleanOptionalAction,
+                          help = "Perform a simple copy and do not transcode, \
+                                  defaults to copying the clips that start on a keyframe")
+    clparser.add_argument("--no-cache",
                           action = "store_true",
-                          help = "Perform a simple copy and do not transcode")
+                          help = "Do not use the keyframes cache stored in $XDG_CACHE_HOME/pyclip")
+    clparser.add_argument("-j", "--jobs",
+                          type = int,
+                          default = os.cpu_count() or 1,
+                          help = "Number of clips to extract in parallel, defaults to the number of CPUs. \
+                                  With 1, all clips are extracted by a single ffmpeg invocation")
+    clparser.add_argument("--ffmpeg-threads",
+                          type = _ffmpeg_threads,
+                          help = "Number of threads used by each ffmpeg process (1 to 64), \
+                                  defaults to splitting the CPUs between parallel jobs")
     clparser.add_argument("timestamps",
                           nargs = "*",
+                          type = _timestamp,
                           help = "Start and end timestamps of the clips to extract, \
                                   must go in pairs : start1 end1 [start2 end2 ...]")
     args = clparser.parse_args()
 
     _init_logger(args.verbose)
 
+    if args.jobs < 1:
+        clparser.error(f"Invalid number of jobs : {args.jobs}")
+
     if len(args.timestamps) < 2 or len(args.timestamps) % 2 != 0:
         clparser.error(f"Mismatched number of timestamps : {len(args.timestamps)}")
 
-    arg_timestamps = iter(args.timestamps)
-    timestamps = zip(arg_timestamps, arg_timestamps)
-
-    clip_nb = 1
-    clip_total = len(args.timestamps) // 2
+    timestamps = list(zip(args.timestamps[0::2], args.timestamps[1::2]))
+    clip_total = len(timestamps)
 
     infile = args.infile
 
     logger.debug("Input file : %s", infile)
 
-    if args.outfile is None or os.path.isdir(args.outfile):
-        infile_match = FILENAME_PATTERN.match(os.path.basename(infile))
-        if infile_match is None:
+    outfile_is_dir = False
+    if args.outfile is not None:
+        try:
+            outfile_is_dir = stat.S_ISDIR(os.stat(args.outfile).st_mode)
+        except OSError:
+            pass
+
+    if args.outfile is None or outfile_is_dir:
+        infile_name, infile_ext = os.path.splitext(os.path.basename(infile))
+        if not infile_ext:
             clparser.error("Output file name could not be generated from input file")
-        outfile_name = infile_match.group("name") + "_clip"
+        outfile_name = infile_name + "_clip"
         if args.outfile is not None:
             outfile_name = os.path.join(args.outfile, outfile_name)
-        outfile_ext = infile_match.group("extension")
+        outfile_ext = infile_ext.lstrip(".")
     else:
-        outfile_match = FILENAME_PATTERN.match(os.path.basename(args.outfile))
-        if outfile_match is None:
+        outfile_name, outfile_ext = os.path.splitext(args.outfile)
+        if not outfile_ext:
             clparser.error("Output file name could not be parsed")
-        outfile_name = os.path.join(os.path.dirname(args.outfile), outfile_match.group("name"))
-        outfile_ext = outfile_match.group("extension")
+        outfile_ext = outfile_ext.lstrip(".")
 
     if args.noaudio and args.novideo:
         logger.warning("The output stream will be empty")
 
-    for start, end in timestamps:
-        logger.info("Extracting clip %s of %s", clip_nb, clip_total)
-        logger.debug("Clip timestamps : %s - %s", start, end)
+    # File names are not used as format strings since they may contain braces
+    outfile_prefix = outfile_name + "_"
+    outfile_suffix = "." + outfile_ext
+
+    # Stream copy is only chosen automatically when the output container is the input's
+    auto_copy = args.copy is None
+    if auto_copy and os.path.splitext(infile)[1].lower() != outfile_suffix.lower():
+        logger.debug("Output container differs from the input, clips will be transcoded")
+        auto_copy = False
+
+    # Without video, clips can be cut on any packet
+    copy_all = auto_copy and args.novideo
+    keyframes = []
+    if auto_copy and not args.novideo:
+        try:
+            keyframes = _keyframes(infile, [_seconds(start) for start, _ in timestamps], not args.no_cache)
+        except (OSError, RuntimeError) as error:
+            logger.warning("Keyframes could not be detected, clips will be transcoded : %s", error)
+        if keyframes is None:
+            copy_all = True
+            keyframes = []
+
+    clips = []
+    transcoded_clips = []
+    for clip_nb, (start, end) in enumerate(timestamps, start = 1):
+        logger.debug("Clip %s timestamps : %s - %s", clip_nb, start, end)
         if clip_total > 1:
-            outfile = outfile_name + f"_{clip_nb:02}." + outfile_ext
+            outfile = f"{outfile_prefix}{clip_nb:02}{outfile_suffix}"
         else:
-            outfile = outfile_name + "." + outfile_ext
-        logger.debug("Extracting to : %s", outfile)
-        clip_nb += 1
-        clip(infile, outfile, start, end, args.noaudio, args.novideo, args.overwrite, args.copy)
+            outfile = outfile_name + outfile_suffix
+        logger.debug("Clip %s output : %s", clip_nb, outfile)
+        transcoded_clips.append(Clip(start, end, outfile))
+        copy = args.copy
+        if copy is None:
+            copy = False
+            if copy_all:
+                copy = True
+            elif auto_copy:
+                keyframe_start = _keyframe_start(keyframes, start)
+                copy = keyframe_start is not None
+                if copy:
+                    start = keyframe_start
+            if copy:
+                logger.debug("Clip %s mode : copy from %s", clip_nb, start)
+            else:
+                logger.debug("Clip %s mode : transcode", clip_nb)
+        clips.append(Clip(start, end, outfile, copy))
+
+    # Automatically stream copied clips are transcoded again if the copy fails
+    retry = auto_copy and any(item.copy for item in clips)
+    if retry and not args.overwrite:
+        # Unless the outputs did not exist, a failure may come from an already existing file
+        retry = not any(os.path.exists(item.outfile) for item in clips)
+
+    if clip_total == 1 and os.name == "posix" and not retry:
+        # Nothing is left to do after FFMPEG: replace the interpreter instead of waiting for a child
+        logger.info("Extracting 1 clip")
+        command = _clip_command(infile, clips, args.noaudio, args.novideo, args.overwrite, args.ffmpeg_threads)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            os.execvp(command[0], command)
+        except OSError as error:
+            logger.error("FFMPEG could not be run : %s", error)
+            return 1
 
+    try:
+        _extract(infile, clips, args.noaudio, args.novideo, args.overwrite,
+                 args.jobs, args.ffmpeg_threads, auto_copy)
+    except RuntimeError as error:
+        if not retry:
+            logger.error("%s", error)
+            return 1
+        logger.warning("Stream copy failed, clips will be transcoded : %s", error)
+        try:
+            # The outputs did not exist before, files left by the failed attempt are replaced
+            _extract(infile, transcoded_clips, args.noaudio, args.novideo, True,
+                     args.jobs, args.ffmpeg_threads, False)
+        except RuntimeError as error:
+            logger.error("%s", error)
+            return 1
 
 if __name__ == "__main__":
     raise SystemExit(main())
@@ -0,0 +1,472 @@
+import io
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from argparse import ArgumentTypeError
+from unittest import mock
+
+import pyclip
+
+from pyclip import Clip
+
+
+class TestSeconds(unittest.TestCase):
+
+    def test_formats(self):
+        self.assertEqual(pyclip._seconds("12"), 12)
+        self.assertEqual(pyclip._seconds("1.5"), 1.5)
+        self.assertEqual(pyclip._seconds("01:02"), 62)
+        self.assertEqual(pyclip._seconds("1:01:02.5"), 3662.5)
+        self.assertEqual(pyclip._seconds("-3"), -3)
+        self.assertEqual(pyclip._seconds("250ms"), 0.25)
+        self.assertEqual(pyclip._seconds("10us"), 0.00001)
+        self.assertEqual(pyclip._seconds("7s"), 7)
+        self.assertEqual(pyclip._seconds("1.5s"), 1.5)
+        self.assertEqual(pyclip._seconds("1:2"), 62)
+
+    def test_invalid(self):
+        for timestamp in ("", "abc", "1:2:3:4"):
+            with self.assertRaises(ValueError):
+                pyclip._seconds(timestamp)
+
+
+class TestTimestamp(unittest.TestCase):
+
+    def test_valid(self):
+        for timestamp in ("5", "-5", "1.25", "250ms", "1.5s", "00:03", "1:02", "1:2", "-1:00:02.5"):
+            self.assertEqual(pyclip._timestamp(timestamp), timestamp)
+
+    def test_invalid(self):
+        for timestamp in ("", "abc", "00:03x", "1:2:3:4", "1:", "1.5.2", "--1"):
+            with self.assertRaises(ArgumentTypeError):
+                pyclip._timestamp(timestamp)
+
+
+class TestFormatter(unittest.TestCase):
+
+    @staticmethod
+    def record(level, msg = "message"):
+        return logging.makeLogRecord({"msg": msg, "levelno": level, "levelname": logging.getLevelName(level)})
+
+    def test_level_colors(self):
+        formatter = pyclip.Formatter("%(levelname)s %(message)s")
+        for level, color in ((logging.DEBUG, pyclip.Formatter.BLUE),
+                             (logging.WARNING, pyclip.Formatter.YELLOW),
+                             (logging.CRITICAL, pyclip.Formatter.RED_BOLD)):
+            with self.subTest(level = level):
+                self.assertEqual(formatter.format(self.record(level)),
+                                 f"{color}{logging.getLevelName(level)} message{pyclip.Formatter.RESET}")
+
+    def test_uncolored_level(self):
+        formatter = pyclip.Formatter("%(levelname)s %(message)s")
+        self.assertEqual(formatter.format(self.record(25)), "Level 25 message")
+
+    def test_no_color(self):
+        formatter = pyclip.Formatter("%(levelname)s %(message)s", use_color = False)
+        self.assertEqual(formatter.format(self.record(logging.ERROR)), "ERROR message")
+
+    def test_logger_output(self):
+        self.addCleanup(pyclip.logger.setLevel, pyclip.logger.level)
+        stdout = io.StringIO()
+        with mock.patch("sys.stdout", stdout):
+            pyclip._init_logger(1)
+        handler = pyclip.logger.handlers[-1]
+        self.addCleanup(pyclip.logger.removeHandler, handler)
+        # Records are not colored when stdout is not a terminal
+        pyclip.logger.info("message %s", 1)
+        self.assertEqual(stdout.getvalue(), "message 1\n")
+
+
+class TestKeyframeStart(unittest.TestCase):
+
+    KEYFRAMES = [0.0, 10.0, 20.0]
+
+    def test_on_keyframe(self):
+        self.assertEqual(pyclip._keyframe_start(self.KEYFRAMES, "10"), "10.000000")
+
+    def test_within_tolerance(self):
+        self.assertEqual(pyclip._keyframe_start(self.KEYFRAMES, "00:10.02"), "10.000000")
+
+    def test_outside_tolerance(self):
+        self.assertIsNone(pyclip._keyframe_start(self.KEYFRAMES, "12"))
+
+    def test_before_first_keyframe(self):
+        self.assertIsNone(pyclip._keyframe_start([1.0], "0.99"))
+        self.assertIsNone(pyclip._keyframe_start([], "0"))
+
+
+class TestSegmentable(unittest.TestCase):
+
+    CLIPS = [Clip("0.000000", "10", "a.mp4", True),
+             Clip("10.000000", "20", "b.mp4", True),
+             Clip("20.000000", "00:25", "c.mp4", True)]
+
+    def test_contiguous(self):
+        self.assertTrue(pyclip._segmentable(self.CLIPS, True))
+
+    def test_not_keyframe_aligned(self):
+        self.assertFalse(pyclip._segmentable(self.CLIPS, False))
+
+    def test_single_clip(self):
+        self.assertFalse(pyclip._segmentable(self.CLIPS[:1], True))
+
+    def test_gap(self):
+        clips = [self.CLIPS[0], Clip("12", "20", "b.mp4", True)]
+        self.assertFalse(pyclip._segmentable(clips, True))
+
+    def test_transcoded_clip(self):
+        clips = [self.CLIPS[0], self.CLIPS[1]._replace(copy = False)]
+        self.assertFalse(pyclip._segmentable(clips, True))
+
+    def test_empty_clip(self):
+        clips = [self.CLIPS[0], Clip("10", "10", "b.mp4", True)]
+        self.assertFalse(pyclip._segmentable(clips, True))
+
+
+class TestClipCommand(unittest.TestCase):
+
+    def test_transcode(self):
+        command = pyclip._clip_command("in.mp4", [Clip("1", "2", "out.mp4")])
+        self.assertEqual(command, ["ffmpeg", "-nostdin", "-loglevel", "error", "-n",
+                                   "-i", "in.mp4",
+                                   "-ss", "1", "-to", "2",
+                                   "out.mp4"])
+
+    def test_mixed_copy_and_transcode(self):
+        clips = [Clip("0", "5", "a.mp4", True),
+                 Clip("12", "15", "b.mp4"),
+                 Clip("00:20", "00:22.5", "c.mp4", True)]
+        command = pyclip._clip_command("in.mp4", clips,
+                                       no_audio = True, overwrite = True, threads = 2)
+        self.assertEqual(command, ["ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                                   "-threads", "2", "-i", "in.mp4",
+                                   "-threads", "2", "-ss", "0", "-i", "in.mp4", "-t", "5.000000",
+                                   "-map", "1:V:0?", "-map", "1:a:0?",
+                                   "-c", "copy", "-threads", "2", "-an", "a.mp4",
+                                   "-ss", "12", "-to", "15",
+                                   "-map", "0:V:0?", "-map", "0:a:0?",
+                                   "-threads", "2", "-an", "b.mp4",
+                                   "-threads", "2", "-ss", "00:20", "-i", "in.mp4", "-t", "2.500000",
+                                   "-map", "2:V:0?", "-map", "2:a:0?",
+                                   "-c", "copy", "-threads", "2", "-an", "c.mp4"])
+
+    def test_copy_only(self):
+        command = pyclip._clip_command("in.mp4", [Clip("3", "5", "out.mkv", True)], no_video = True)
+        self.assertEqual(command, ["ffmpeg", "-nostdin", "-loglevel", "error", "-n",
+                                   "-ss", "3", "-i", "in.mp4", "-t", "2.000000",
+                                   "-c", "copy", "-vn", "out.mkv"])
+
+
+class TestRunFfmpeg(unittest.TestCase):
+
+    def test_failure(self):
+        error = subprocess.CalledProcessError(1, ["ffmpeg"], stderr = "File 'out.mp4' already exists. Exiting.\n")
+        with mock.patch("subprocess.run", side_effect = error):
+            with self.assertRaisesRegex(RuntimeError, "code 1 : File 'out.mp4' already exists. Exiting.$"):
+                pyclip._run_ffmpeg(["ffmpeg"])
+
+    def test_missing_binary(self):
+        with mock.patch("subprocess.run", side_effect = FileNotFoundError(2, "No such file or directory")):
+            with self.assertRaisesRegex(RuntimeError, "FFMPEG could not be run"):
+                pyclip._run_ffmpeg(["ffmpeg"])
+            with self.assertRaisesRegex(RuntimeError, "FFPROBE could not be run"):
+                pyclip._run_ffprobe(["in.mp4"])
+
+
+class TestProbeParsing(unittest.TestCase):
+
+    def test_probe_info(self):
+        self.assertEqual(pyclip._parse_probe_info("stream,0\nformat,1.400000\n"), (True, 1.4))
+        self.assertEqual(pyclip._parse_probe_info("format,N/A\n"), (False, 0.0))
+
+    def test_keyframes(self):
+        output = "11.400000,K__\n1.400000,K_\n1.440000,___\nN/A,K__\n"
+        self.assertEqual(pyclip._parse_keyframes(output, 1.4), [0.0, 10.0])
+
+
+class TestKeyframes(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.infile = os.path.join(directory.name, "in.ts")
+        with open(self.infile, "wb"):
+            pass
+        patcher = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(directory.name, "cache")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(pyclip._keyframes_cache, clear = True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_intervals_are_absolute_and_probed_once(self):
+        outputs = ["stream,0\nformat,1.400000\n", "11.400000,K__\n"]
+        with mock.patch("pyclip._run_ffprobe", side_effect = outputs) as run_ffprobe:
+            self.assertEqual(pyclip._keyframes(self.infile, [10.0]), [10.0])
+            self.assertIn("11.350000%11.450000", run_ffprobe.call_args.args[0])
+            pyclip._keyframes_cache.clear()
+            # Read back from the disk cache without running FFPROBE
+            self.assertEqual(pyclip._keyframes(self.infile, [10.0]), [10.0])
+        self.assertEqual(run_ffprobe.call_count, 2)
+
+    def test_no_video_stream(self):
+        with mock.patch("pyclip._run_ffprobe", return_value = "format,0.000000\n") as run_ffprobe:
+            self.assertIsNone(pyclip._keyframes(self.infile, [10.0]))
+        self.assertEqual(run_ffprobe.call_count, 1)
+
+
+class TestKeyframesCache(unittest.TestCase):
+
+    PROBE = {"start_time": 1.4, "video": True, "windows": [[0.0, 0.05]], "keyframes": [0.0]}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_file = os.path.join(directory.name, "pyclip", "probe.json")
+
+    def test_round_trip(self):
+        key = ("/videos/in.ts", 10, 20)
+        pyclip._write_keyframes_cache(self.cache_file, key, self.PROBE)
+        self.assertEqual(pyclip._read_keyframes_cache(self.cache_file, key), self.PROBE)
+
+    def test_modified_file(self):
+        pyclip._write_keyframes_cache(self.cache_file, ("/videos/in.ts", 10, 20), self.PROBE)
+        self.assertIsNone(pyclip._read_keyframes_cache(self.cache_file, ("/videos/in.ts", 10, 21)))
+
+    def test_failed_write(self):
+        key = ("/videos/in.ts", 10, 20)
+        pyclip._write_keyframes_cache(self.cache_file, key, {**self.PROBE, "keyframes": [object()]})
+        with mock.patch("os.replace", side_effect = PermissionError(13, "Permission denied")):
+            pyclip._write_keyframes_cache(self.cache_file, key, self.PROBE)
+        # No temporary file is left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)), [])
+
+    def test_missing_or_corrupted(self):
+        key = ("/videos/in.ts", 10, 20)
+        self.assertIsNone(pyclip._read_keyframes_cache(self.cache_file, key))
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, "w", encoding = "utf-8") as file:
+            file.write("{")
+        self.assertIsNone(pyclip._read_keyframes_cache(self.cache_file, key))
+
+
+class Executed(Exception):
+    """Raised instead of replacing the test process with os.execvp"""
+
+
+class MainTestCase(unittest.TestCase):
+    """Runs main() in a temporary directory, recording the commands instead of running them"""
+
+    PROBE_INFO = "stream,0\nformat,0.000000\n"
+    PACKETS = "0.000000,K__\n10.000000,K__\n20.000000,K__\n"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+        with open("in.mp4", "wb"):
+            pass
+        self.commands = []
+        for patcher in (mock.patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(self.directory, "cache")}),
+                        mock.patch.dict(pyclip._keyframes_cache, clear = True),
+                        mock.patch("subprocess.run", side_effect = self.run_command),
+                        mock.patch("os.execvp", side_effect = self.execvp)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Keep the logging module's last resort handler quiet
+        handler = logging.NullHandler()
+        pyclip.logger.addHandler(handler)
+        self.addCleanup(pyclip.logger.removeHandler, handler)
+
+    def fails(self, command):
+        """Whether a recorded command should fail"""
+        return False
+
+    def run_command(self, command, **kwargs):
+        self.commands.append(command)
+        if self.fails(command):
+            raise subprocess.CalledProcessError(1, command, stderr = "Error\n")
+        if "segment" in command:
+            self.write_segments(command)
+        stdout = ""
+        if command[0] == "ffprobe":
+            stdout = self.PACKETS if "-read_intervals" in command else self.PROBE_INFO
+        return subprocess.CompletedProcess(command, 0, stdout, "")
+
+    # Number of segments the segment muxer fails to produce
+    missing_segments = 0
+
+    def write_segments(self, command):
+        segment_total = command[command.index("-segment_times") + 1].count(",") + 2 - self.missing_segments
+        for segment_nb in range(segment_total):
+            with open(command[-1] % segment_nb, "w", encoding = "utf-8") as file:
+                file.write(f"segment {segment_nb}")
+
+    def execvp(self, file, args):
+        self.commands.append(args)
+        raise Executed()
+
+    def main(self, *argv):
+        with mock.patch.object(sys, "argv", ["pyclip", *argv]):
+            try:
+                return pyclip.main()
+            except Executed:
+                return "exec"
+
+    def ffmpeg_commands(self):
+        return [command for command in self.commands if command[0] == "ffmpeg"]
+
+
+class TestMainExec(MainTestCase):
+
+    @unittest.skipUnless(os.name == "posix", "FFMPEG is only executed directly on POSIX")
+    def test_single_clip(self):
+        self.assertEqual(self.main("-i", "in.mp4", "--no-copy", "1", "2"), "exec")
+        self.assertEqual(self.ffmpeg_commands(), [["ffmpeg", "-nostdin", "-loglevel", "error", "-n",
+                                                   "-i", "in.mp4", "-ss", "1", "-to", "2", "in_clip.mp4"]])
+
+    def test_several_clips(self):
+        self.assertEqual(self.main("-i", "in.mp4", "-j", "1", "--no-copy", "1", "2", "3", "4"), None)
+        self.assertEqual(len(self.ffmpeg_commands()), 1)
+
+    @unittest.skipUnless(os.name == "posix", "FFMPEG is only executed directly on POSIX")
+    def test_missing_ffmpeg(self):
+        with mock.patch("os.execvp", side_effect = FileNotFoundError(2, "No such file or directory")):
+            self.assertEqual(self.main("-i", "in.mp4", "--no-copy", "1", "2"), 1)
+
+
+class TestMainAutoCopy(MainTestCase):
+
+    def test_keyframe_start(self):
+        self.assertIsNone(self.main("-i", "in.mp4", "-j", "1", "00:10.02", "15", "12", "13"))
+        self.assertEqual(self.ffmpeg_commands(),
+                         [["ffmpeg", "-nostdin", "-loglevel", "error", "-n",
+                           "-i", "in.mp4",
+                           "-ss", "10.000000", "-i", "in.mp4", "-t", "5.000000",
+                           "-map", "1:V:0?", "-map", "1:a:0?", "-c", "copy", "in_clip_01.mp4",
+                           "-ss", "12", "-to", "13",
+                           "-map", "0:V:0?", "-map", "0:a:0?", "in_clip_02.mp4"]])
+
+    def test_other_container(self):
+        self.assertIsNone(self.main("-i", "in.mp4", "-o", "out.mp3", "-j", "1", "--novideo", "0", "10", "12", "13"))
+        self.assertEqual([command[0] for command in self.commands], ["ffmpeg"])
+        self.assertNotIn("copy", self.commands[0])
+
+    def test_copy_failure(self):
+        self.fails = lambda command: "copy" in command
+        self.assertIsNone(self.main("-i", "in.mp4", "10", "15"))
+        self.assertEqual(self.ffmpeg_commands()[-1], ["ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                                                      "-i", "in.mp4", "-ss", "10", "-to", "15", "in_clip.mp4"])
+
+    def test_copy_failure_existing_output(self):
+        self.fails = lambda command: "copy" in command
+        with open("in_clip_02.mp4", "wb"):
+            pass
+        self.assertEqual(self.main("-i", "in.mp4", "-j", "1", "10", "15", "20", "25"), 1)
+        self.assertEqual(len(self.ffmpeg_commands()), 1)
+
+    def test_explicit_copy_failure(self):
+        self.fails = lambda command: "copy" in command
+        self.assertEqual(self.main("-i", "in.mp4", "-j", "1", "--copy", "10", "15", "17", "20"), 1)
+        self.assertEqual(len(self.ffmpeg_commands()), 1)
+
+
+class TestMainSegments(MainTestCase):
+
+    def read(self, path):
+        with open(path, encoding = "utf-8") as file:
+            return file.read()
+
+    def test_contiguous_clips(self):
+        self.assertIsNone(self.main("-i", "in.mp4", "0", "10", "10", "20", "20", "25"))
+        command, = self.ffmpeg_commands()
+        self.assertEqual(command[:-1], ["ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                                        "-ss", "0.000000", "-i", "in.mp4", "-t", "25.000000", "-c", "copy",
+                                        "-f", "segment", "-segment_times", "10.000000,20.000000",
+                                        "-reset_timestamps", "1"])
+        self.assertEqual([self.read(f"in_clip_{clip_nb:02}.mp4") for clip_nb in (1, 2, 3)],
+                         ["segment 0", "segment 1", "segment 2"])
+        # The temporary segment directory is removed
+        self.assertEqual(sorted(os.listdir()), ["cache", "in.mp4", "in_clip_01.mp4", "in_clip_02.mp4", "in_clip_03.mp4"])
+
+    def test_missing_segment(self):
+        self.missing_segments = 1
+        self.assertIsNone(self.main("-i", "in.mp4", "0", "10", "10", "20"))
+        segment_command, command = self.ffmpeg_commands()
+        self.assertIn("segment", segment_command)
+        self.assertEqual(command[-1], "in_clip_02.mp4")
+        self.assertNotIn("in_clip_01.mp4", os.listdir())
+
+    def test_explicit_copy(self):
+        self.assertIsNone(self.main("-i", "in.mp4", "-j", "1", "--copy", "0", "10", "10", "20"))
+        command, = self.ffmpeg_commands()
+        self.assertNotIn("segment", command)
+
+    def test_existing_output(self):
+        with open("in_clip_02.mp4", "wb"):
+            pass
+        clips = [Clip("0", "10", "in_clip_01.mp4", True), Clip("10", "20", "in_clip_02.mp4", True)]
+        with self.assertRaisesRegex(RuntimeError, "in_clip_02.mp4' already exists"):
+            pyclip.clip_segments("in.mp4", clips)
+        self.assertEqual(self.commands, [])
+
+
+class TestMainOutputNames(MainTestCase):
+
+    def outfiles(self, *argv):
+        """Output files of the clips extracted from in.mp4"""
+        self.main("-i", "in.mp4", "-j", "1", "--no-copy", *argv)
+        return [command[index + 2] for command in self.ffmpeg_commands()
+                for index, argument in enumerate(command) if argument == "-to"]
+
+    def assertUsageError(self, *argv):
+        with mock.patch("sys.stderr", io.StringIO()), self.assertRaises(SystemExit):
+            self.main(*argv)
+        self.assertEqual(self.commands, [])
+
+    def test_input_name(self):
+        self.assertEqual(self.outfiles("1", "2"), ["in_clip.mp4"])
+
+    def test_output_name(self):
+        self.assertEqual(self.outfiles("-o", "my.clip.mp4", "1", "2"), ["my.clip.mp4"])
+
+    def test_numbered_names(self):
+        self.assertEqual(self.outfiles("1", "2", "3", "4", "5", "6"), ["in_clip_01.mp4", "in_clip_02.mp4", "in_clip_03.mp4"])
+        self.commands.clear()
+        self.assertEqual(self.outfiles("-o", "out.mkv", "1", "2", "3", "4"), ["out_01.mkv", "out_02.mkv"])
+
+    def test_braces(self):
+        self.assertEqual(self.outfiles("-o", "{0}_{}.mp4", "1", "2", "3", "4"), ["{0}_{}_01.mp4", "{0}_{}_02.mp4"])
+
+    def test_output_directory(self):
+        os.mkdir("out.d")
+        self.assertEqual(self.outfiles("-o", "out.d", "1", "2", "3", "4"),
+                         [os.path.join("out.d", "in_clip_01.mp4"), os.path.join("out.d", "in_clip_02.mp4")])
+
+    def test_missing_output_directory(self):
+        self.assertEqual(self.outfiles("-o", os.path.join("missing", "out.mp4"), "1", "2"),
+                         [os.path.join("missing", "out.mp4")])
+
+    def test_dotted_input_name(self):
+        with open("my.video.mkv", "wb"):
+            pass
+        self.main("-i", "my.video.mkv", "--no-copy", "1", "2")
+        self.assertEqual(self.ffmpeg_commands()[0][-1], "my.video_clip.mkv")
+
+    def test_dotfile_input(self):
+        with open(".video", "wb"):
+            pass
+        self.assertUsageError("-i", ".video", "1", "2")
+
+    def test_output_without_extension(self):
+        self.assertUsageError("-i", "in.mp4", "-o", "clip", "1", "2")
+
+
+if __name__ == "__main__":
+    unittest.main()